@@ -4,70 +4,273 @@ KFO Merino Yarn Scraper - Download images and extract hex colors
 """
 
 import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
+import soupsieve as sv
 from PIL import Image
+import numpy as np
+import orjson
 import os
-import json
+import logging
 import time
+import io
+import multiprocessing
+import threading
+from collections import deque
+from datetime import timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urljoin
 
+log = logging.getLogger('kfo')
+
 # ===== CONFIGURATION =====
+# Per-item progress is logged at DEBUG; set to logging.DEBUG to see it
+LOG_LEVEL = logging.INFO
+
 BASE_URL = "https://knittingforolive.com"
 # This is the typical URL pattern - adjust after testing
 COLLECTION_URL = f"{BASE_URL}/collections/knitting-for-olives-merino"
+# Shopify exposes the same collection as JSON; the HTML pages are a fallback
+COLLECTION_JSON_URL = f"{COLLECTION_URL}/products.json"
+PRODUCTS_PER_PAGE = 250  # Shopify's maximum
 
 OUTPUT_DIR = "./kfo_yarn_data"
 IMAGES_DIR = os.path.join(OUTPUT_DIR, "images")
-os.makedirs(IMAGES_DIR, exist_ok=True)
+
+# HTML parsing - lxml is several times faster than html.parser.
+# Selectors are tried in priority order and compiled once up front.
+PARSER = 'lxml'
+COLLECTION_SELECTORS = [sv.compile(selector) for selector in [
+    'a[href*="/products/merino"]',
+    '.product-card a',
+    '.product-item a',
+    'a.product-link'
+]]
+TITLE_SELECTORS = [sv.compile(selector) for selector in [
+    'h1.product-title', 'h1', '.product-title', 'title'
+]]
+IMAGE_SELECTORS = [sv.compile(selector) for selector in [
+    'img.product-image',
+    '.product-gallery img',
+    'img[src*="merino"]',
+    '.main-image img'
+]]
+PRICE_SELECTORS = [sv.compile(selector) for selector in [
+    '.price', '.product-price', 'span[class*="price"]'
+]]
 
 # Be polite to the server
-DELAY_BETWEEN_REQUESTS = 1  # seconds
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
+MAX_WORKERS = 8  # requests in flight at once
+REQUESTS_PER_SECOND = 2  # new requests started per second, across all workers
+
+# Hex colors are extracted from the downloaded bytes; set to False to skip
+# writing the images to IMAGES_DIR
+SAVE_IMAGES = True
+
+# Images are decoded at a reduced size no smaller than this for color sampling.
+# Smaller drafts shift the dominant bin on darker or speckled yarns
+DECODE_SIZE = (1024, 1024)
+
+# Center regions are shrunk to this size before binning, so yarn texture,
+# shadows and label text average out
+THUMB_SIZE = (64, 64)
+
+# Hex colors are extracted this many images at a time
+HEX_BATCH_SIZE = 32
+
+# Dominant color histogram resolution, and the brightness above which
+# neutral-to-cool pixels are treated as the label/background
+HIST_BITS = 4
+LABEL_MIN_BRIGHTNESS = 0xd8
+
+# Decoding is CPU-bound, so it runs in one process per usable core
+if hasattr(os, 'sched_getaffinity'):
+    DECODE_WORKERS = len(os.sched_getaffinity(0))
+else:
+    DECODE_WORKERS = os.cpu_count() or 1
+
+# The decode workers start while download threads hold session, SQLite and
+# urllib3 locks, so spawn fresh interpreters rather than forking
+DECODE_CONTEXT = multiprocessing.get_context('spawn')
+
+# Every request goes to the same host, so share one session and reuse
+# its keep-alive connections instead of a new TCP/TLS handshake per call.
+# Responses are cached on disk so reruns skip unchanged pages and images.
+CACHE_FILE = os.path.join(OUTPUT_DIR, "http_cache")
+CACHE_EXPIRE_AFTER = timedelta(days=1)
+# Opened by main() rather than at import, since every spawned decode worker
+# re-imports this module and must not touch the cache
+SESSION = None
+
+
+def create_session():
+    """
+    Create the shared cached session with retries and a connection pool
+    """
+    session = requests_cache.CachedSession(
+        CACHE_FILE,
+        backend='sqlite',
+        expire_after=CACHE_EXPIRE_AFTER,
+        allowable_methods=('GET',)
+    )
+    session.headers['User-Agent'] = USER_AGENT
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3)
+    )
+    session.mount('https://', adapter)
+    return session
+
+
+def configure_logging(level):
+    """
+    Set up log output; also run in each decode worker, which starts unconfigured
+    """
+    logging.basicConfig(level=level, format='%(asctime)s %(message)s')
+
+
+class RateLimiter:
+    """
+    Block callers once max_calls have started within the last period seconds
+    """
+
+    def __init__(self, max_calls, period=1.0):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] >= self.period:
+                self.calls.popleft()
+            if len(self.calls) >= self.max_calls:
+                time.sleep(self.period - (now - self.calls[0]))
+                self.calls.popleft()
+            self.calls.append(time.monotonic())
+
+
+RATE_LIMITER = RateLimiter(REQUESTS_PER_SECOND)
+
+
+class SafeNameTable(dict):
+    """
+    str.translate table for filenames: keeps alphanumerics, ' ', '-' and '_'
+    and drops everything else. Entries are filled in on first use, so any
+    Unicode character is handled like str.isalnum does
+    """
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        self[codepoint] = codepoint if char.isalnum() or char in ' -_' else None
+        return self[codepoint]
+
+
+SAFE_NAME_TABLE = SafeNameTable()
+
+
+def polite_get(url, params=None):
+    """
+    GET through the shared session, rate limiting only requests that
+    can't be answered from the local cache
+    """
+    full_url = requests.Request('GET', url, params=params).prepare().url
+    
+    # Expired entries stay in the cache until refetched, so check freshness
+    # rather than just presence
+    key = SESSION.cache.create_key(requests.Request('GET', full_url))
+    cached = SESSION.cache.get_response(key)
+    if cached is None or cached.is_expired:
+        RATE_LIMITER.wait()
+    return SESSION.get(full_url, timeout=10)
+
+
+def scrape_yarn_collection_json():
+    """
+    Read every product in the collection from Shopify's products.json endpoint
+    Returns a list of yarn data dicts, or None if the endpoint is unavailable
+    """
+    log.info("Fetching collection JSON: %s", COLLECTION_JSON_URL)
+    
+    all_yarn_data = []
+    page = 1
+    while True:
+        try:
+            response = polite_get(
+                COLLECTION_JSON_URL,
+                params={'limit': PRODUCTS_PER_PAGE, 'page': page}
+            )
+            
+            if response.status_code != 200:
+                log.warning("Could not access %s (status code %s)", COLLECTION_JSON_URL, response.status_code)
+                return None
+            
+            # A password page or bot challenge can come back as a 200 HTML page
+            products = response.json().get('products', [])
+            
+        except (requests.RequestException, ValueError) as e:
+            log.warning("Could not read %s: %s", COLLECTION_JSON_URL, e)
+            return None
+        
+        if not products:
+            break
+        
+        for product in products:
+            images = product.get('images') or [{}]
+            variants = product.get('variants') or [{}]
+            all_yarn_data.append({
+                'url': urljoin(BASE_URL, f"/products/{product['handle']}"),
+                'name': product.get('title'),
+                'color': None,
+                'image_url': images[0].get('src'),
+                'price': variants[0].get('price')
+            })
+        
+        page += 1
+    
+    log.info("Total products found: %d", len(all_yarn_data))
+    return all_yarn_data
 
 
 def scrape_yarn_collection():
     """
     Scrape the KFO Merino collection page for yarn links
     """
-    print(f"Scraping collection page: {COLLECTION_URL}")
+    log.info("Scraping collection page: %s", COLLECTION_URL)
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
-    }
-    
-    response = requests.get(COLLECTION_URL, headers=headers)
+    response = polite_get(COLLECTION_URL)
     
     if response.status_code != 200:
-        print(f"Error: Could not access {COLLECTION_URL}")
-        print(f"Status code: {response.status_code}")
+        log.error("Could not access %s (status code %s)", COLLECTION_URL, response.status_code)
         return []
     
-    soup = BeautifulSoup(response.content, 'html.parser')
+    soup = BeautifulSoup(response.content, PARSER)
     
-    # Find all product links (adjust selectors based on actual HTML)
+    # Find all product links (adjust COLLECTION_SELECTORS based on actual HTML)
     # Common patterns: .product-card, .product-item, a[href*='/products/']
     product_links = []
+    seen_links = set()
     
     # Try multiple common selectors
-    selectors = [
-        'a[href*="/products/merino"]',
-        '.product-card a',
-        '.product-item a',
-        'a.product-link'
-    ]
-    
-    for selector in selectors:
-        links = soup.select(selector)
+    for selector in COLLECTION_SELECTORS:
+        links = selector.select(soup)
         if links:
-            print(f"Found {len(links)} products using selector: {selector}")
+            log.info("Found %d products using selector: %s", len(links), selector.pattern)
             for link in links:
                 href = link.get('href')
                 if href and '/products/' in href:
                     full_url = urljoin(BASE_URL, href)
-                    if full_url not in product_links:
+                    if full_url not in seen_links:
+                        seen_links.add(full_url)
                         product_links.append(full_url)
             break
     
-    print(f"Total unique product links found: {len(product_links)}")
+    log.info("Total unique product links found: %d", len(product_links))
     return product_links
 
 
@@ -75,19 +278,15 @@ def scrape_yarn_details(product_url):
     """
     Scrape individual yarn product page for details and image
     """
-    print(f"Scraping: {product_url}")
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
-    }
+    log.debug("Scraping: %s", product_url)
     
-    response = requests.get(product_url, headers=headers)
+    response = polite_get(product_url)
     
     if response.status_code != 200:
-        print(f"Error accessing {product_url}")
+        log.error("Error accessing %s (status code %s)", product_url, response.status_code)
         return None
     
-    soup = BeautifulSoup(response.content, 'html.parser')
+    soup = BeautifulSoup(response.content, PARSER)
     
     # Extract yarn details (adjust selectors based on actual HTML)
     yarn_data = {
@@ -99,22 +298,15 @@ def scrape_yarn_details(product_url):
     }
     
     # Try to find product title
-    title_selectors = ['h1.product-title', 'h1', '.product-title', 'title']
-    for selector in title_selectors:
-        title = soup.select_one(selector)
+    for selector in TITLE_SELECTORS:
+        title = selector.select_one(soup)
         if title:
             yarn_data['name'] = title.get_text().strip()
             break
     
     # Try to find main product image
-    image_selectors = [
-        'img.product-image',
-        '.product-gallery img',
-        'img[src*="merino"]',
-        '.main-image img'
-    ]
-    for selector in image_selectors:
-        img = soup.select_one(selector)
+    for selector in IMAGE_SELECTORS:
+        img = selector.select_one(soup)
         if img:
             image_url = img.get('src') or img.get('data-src')
             if image_url:
@@ -122,9 +314,8 @@ def scrape_yarn_details(product_url):
                 break
     
     # Try to find price
-    price_selectors = ['.price', '.product-price', 'span[class*="price"]']
-    for selector in price_selectors:
-        price = soup.select_one(selector)
+    for selector in PRICE_SELECTORS:
+        price = selector.select_one(soup)
         if price:
             yarn_data['price'] = price.get_text().strip()
             break
@@ -134,43 +325,80 @@ def scrape_yarn_details(product_url):
 
 def download_image(image_url, yarn_name):
     """
-    Download yarn image
+    Download yarn image, saving a copy to IMAGES_DIR if SAVE_IMAGES is set
+    Returns (local image path or None, image bytes or None)
     """
-    print(f"Downloading image: {yarn_name}")
+    log.debug("Downloading image: %s", yarn_name)
     
     try:
-        response = requests.get(image_url, timeout=10)
+        response = polite_get(image_url)
+        
+        if response.status_code != 200:
+            log.error("Failed to download %s: %s", image_url, response.status_code)
+            return None, None
+        
+        body = response.content
         
-        if response.status_code == 200:
-            # Create safe filename
-            safe_name = "".join(c for c in yarn_name if c.isalnum() or c in (' ', '-', '_')).strip()
-            safe_name = safe_name.replace(' ', '_')
-            filename = f"{safe_name}.jpg"
-            filepath = os.path.join(IMAGES_DIR, filename)
-            
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-            
-            print(f"Saved: {filepath}")
-            return filepath
-        else:
-            print(f"Failed to download: {response.status_code}")
-            return None
-            
     except Exception as e:
-        print(f"Error downloading image: {e}")
-        return None
+        log.error("Error downloading image %s: %s", image_url, e)
+        return None, None
+    
+    if not SAVE_IMAGES:
+        return None, body
+    
+    # A failed save only loses the local copy; the hex can still be extracted
+    try:
+        # Create safe filename
+        safe_name = yarn_name.translate(SAFE_NAME_TABLE).strip().replace(' ', '_')
+        filename = f"{safe_name}.jpg"
+        filepath = os.path.join(IMAGES_DIR, filename)
+        
+        with open(filepath, 'wb') as f:
+            f.write(body)
+        
+        log.debug("Saved: %s", filepath)
+        return filepath, body
+        
+    except Exception as e:
+        log.error("Error saving image %s: %s", yarn_name, e)
+        return None, body
+
+
+def scrape_yarn(product_url):
+    """
+    Scrape a product page, then download its image in one task,
+    so a worker can move on to the image as soon as its page is parsed
+    """
+    return fetch_yarn_image(scrape_yarn_details(product_url))
 
 
-def extract_hex_from_image(image_path):
+def fetch_yarn_image(yarn_data):
     """
-    Extract hex color from yarn image
-    Uses center crop and averaging
+    Download the image of an already scraped yarn
+    Returns (yarn data, image bytes or None)
     """
-    print(f"Extracting hex from: {os.path.basename(image_path)}")
+    body = None
+    if yarn_data and yarn_data['image_url']:
+        filepath, body = download_image(yarn_data['image_url'], yarn_data['name'])
+        yarn_data['local_image_path'] = filepath
+    
+    return yarn_data, body
+
+
+def load_center_thumbnail(image_bytes, yarn_name):
+    """
+    Decode downloaded yarn image bytes into a THUMB_SIZE RGB array
+    of the image's center region
+    """
+    log.debug("Decoding image: %s", yarn_name)
     
     try:
-        img = Image.open(image_path)
+        # Decode from the downloaded bytes rather than reading the file back
+        img = Image.open(io.BytesIO(image_bytes))
+        
+        # Let libjpeg downscale while decoding (no-op for other formats);
+        # the color sample doesn't need full resolution
+        img.draft('RGB', DECODE_SIZE)
         
         # Convert to RGB if necessary
         if img.mode != 'RGB':
@@ -183,78 +411,154 @@ def extract_hex_from_image(image_path):
         right = int(width * 0.7)
         bottom = int(height * 0.7)
         
-        center_crop = img.crop((left, top, right, bottom))
-        
-        # Resize to 1x1 to get average color
-        center_crop = center_crop.resize((1, 1), Image.Resampling.LANCZOS)
-        avg_color = center_crop.getpixel((0, 0))
-        
-        r, g, b = avg_color
-        hex_color = f"#{r:02x}{g:02x}{b:02x}"
-        
-        print(f"Extracted: {hex_color}")
-        return hex_color
+        # Crop and shrink in a single resize call, straight to a common small
+        # size, so texture averages out and a whole batch can be reduced at once
+        thumb = img.resize(THUMB_SIZE, Image.Resampling.BOX, box=(left, top, right, bottom))
+        return np.asarray(thumb)
         
     except Exception as e:
-        print(f"Error extracting hex: {e}")
+        log.error("Error decoding image %s: %s", yarn_name, e)
         return None
 
 
+def extract_hex_colors(thumbs):
+    """
+    Extract hex colors from a batch of THUMB_SIZE RGB arrays
+    Uses the dominant color of a quantized histogram, ignoring the label
+    """
+    if not thumbs:
+        return []
+    
+    pixels = np.stack(thumbs).reshape(len(thumbs), -1, 3)
+    
+    # The white label and background are flat enough to outnumber any single
+    # bin of textured yarn, so drop bright, cool-white pixels - unless that's
+    # nearly all of the image, as with white yarns
+    label = (pixels.min(axis=2) >= LABEL_MIN_BRIGHTNESS) & (pixels[..., 2] >= pixels[..., 0])
+    label[label.mean(axis=1) > 0.9] = False
+    
+    # Bin the rest into a HIST_BITS-per-channel histogram so highlights and
+    # shadows don't pull the color toward grey. Quantize on uint8 before
+    # widening; the bin indices fit in uint16
+    n_bins = 1 << (3 * HIST_BITS)
+    quantized = pixels >> (8 - HIST_BITS)
+    bins = quantized[..., 0].astype(np.uint16) << (2 * HIST_BITS)
+    bins |= quantized[..., 1].astype(np.uint16) << HIST_BITS
+    bins |= quantized[..., 2]
+    bins[label] = n_bins  # one extra bin per image collects the label
+    
+    # Offset each image's bins into its own range so a single bincount
+    # builds every image's histogram at once
+    offsets = np.arange(len(thumbs), dtype=np.uint32)[:, None] * (n_bins + 1)
+    counts = np.bincount((bins + offsets).ravel(), minlength=len(thumbs) * (n_bins + 1))
+    histograms = counts.reshape(len(thumbs), -1)[:, :n_bins]
+    dominant_bins = histograms.argmax(axis=1)
+    dominant_counts = histograms[np.arange(len(thumbs)), dominant_bins]
+    
+    # Average only the pixels in each image's most populous bin. Selected
+    # pixels come out grouped by image, so one reduceat sums every image's
+    # run at once instead of looping over the batch
+    selected = pixels[bins == dominant_bins[:, None]].astype(np.uint32)
+    starts = np.concatenate(([0], np.cumsum(dominant_counts)[:-1]))
+    sums = np.add.reduceat(selected, starts, axis=0)
+    means = (sums / dominant_counts[:, None]).round().astype(int)
+    
+    return [f"#{r:02x}{g:02x}{b:02x}" for r, g, b in means]
+
+
 def main():
+    global SESSION
+    
+    configure_logging(LOG_LEVEL)
+    os.makedirs(IMAGES_DIR, exist_ok=True)
+    SESSION = create_session()
+    
     all_yarn_data = []
     
-    # Step 1: Get all product links
-    print("Scraping collection page...")
-    product_links = scrape_yarn_collection()
+    # Step 1: Get all products, from the JSON endpoint when available
+    log.info("Scraping collection...")
+    products = scrape_yarn_collection_json()
+    
+    if products:
+        process_product = fetch_yarn_image
+    else:
+        # Fall back to scraping the HTML collection and product pages
+        products = scrape_yarn_collection()
+        process_product = scrape_yarn
     
-    if not product_links:
-        print("No products found. The website structure may have changed.")
-        print("Please check the URL and HTML selectors in the script.")
+    if not products:
+        log.error("No products found. The website structure may have changed.")
+        log.error("Please check the URL and HTML selectors in the script.")
         return
     
-    # Step 2: Scrape each product
-    print(f"Scraping {len(product_links)} individual products...")
-    for i, url in enumerate(product_links, 1):
-        print(f"Product {i}/{len(product_links)}")
+    # Step 2: Scrape each product and download its image on the thread pool,
+    # while a process pool decodes the images into center thumbnails.
+    # Hex colors are then extracted a batch of thumbnails at a time, and each
+    # batch is appended to the NDJSON file right away, so a crashed or
+    # interrupted run keeps everything processed so far
+    log.info("Processing %d individual products...", len(products))
+    stream_file = os.path.join(OUTPUT_DIR, "yarn_data.ndjson")
+    pending = deque()
+    batch = []
+    
+    def write_finished(wait=False):
+        # Move yarns into the batch in collection order as thumbnails come back
+        while pending:
+            yarn_data, thumb_future = pending[0]
+            if thumb_future and not wait and not thumb_future.done():
+                break
+            pending.popleft()
+            batch.append((yarn_data, thumb_future.result() if thumb_future else None))
         
-        yarn_data = scrape_yarn_details(url)
+        if len(batch) < HEX_BATCH_SIZE and not (wait and batch):
+            return
         
-        if yarn_data and yarn_data['image_url']:
+        thumbs = [thumb for _, thumb in batch if thumb is not None]
+        hex_colors = iter(extract_hex_colors(thumbs))
+        for yarn_data, thumb in batch:
+            yarn_data['hex_color'] = next(hex_colors) if thumb is not None else None
+            log.debug("Extracted %s: %s", yarn_data['name'], yarn_data['hex_color'])
             all_yarn_data.append(yarn_data)
+            out.write(orjson.dumps(yarn_data) + b'\n')
+        batch.clear()
+    
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor, \
+            ProcessPoolExecutor(max_workers=DECODE_WORKERS, mp_context=DECODE_CONTEXT,
+                                initializer=configure_logging, initargs=(LOG_LEVEL,)) as decoder, \
+            open(stream_file, 'wb') as out:
+        try:
+            results = executor.map(process_product, products)
+            for i, (yarn_data, body) in enumerate(results, 1):
+                log.info("Product %d/%d", i, len(products))
+                
+                if yarn_data and yarn_data['image_url']:
+                    thumb_future = None
+                    if body:
+                        thumb_future = decoder.submit(load_center_thumbnail, body, yarn_data['name'])
+                    pending.append((yarn_data, thumb_future))
+                
+                write_finished()
         
-        # Be polite - don't hammer the server
-        time.sleep(DELAY_BETWEEN_REQUESTS)
-    
-    # Step 3: Download images
-    print(f"Downloading {len(all_yarn_data)} images...")
-    for yarn_data in all_yarn_data:
-        if yarn_data['image_url']:
-            filepath = download_image(yarn_data['image_url'], yarn_data['name'])
-            yarn_data['local_image_path'] = filepath
-            time.sleep(0.5)  # Brief delay between downloads
-    
-    # Step 4: Extract hex colors
-    print(f"Extracting hex colors...")
-    for yarn_data in all_yarn_data:
-        if yarn_data.get('local_image_path'):
-            hex_color = extract_hex_from_image(yarn_data['local_image_path'])
-            yarn_data['hex_color'] = hex_color
+        finally:
+            # Flush the partial batch too, so a product that raises doesn't
+            # lose everything already processed
+            write_finished(wait=True)
     
     # Save results to JSON
     output_file = os.path.join(OUTPUT_DIR, "yarn_data.json")
-    with open(output_file, 'w') as f:
-        json.dump(all_yarn_data, f, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(all_yarn_data, option=orjson.OPT_INDENT_2))
     
-    print("scraping complete!")
-    print(f"Total yarns processed: {len(all_yarn_data)}")
-    print(f"Images saved to: {IMAGES_DIR}")
-    print(f"Data saved to: {output_file}")
+    log.info("Scraping complete!")
+    log.info("Total yarns processed: %d", len(all_yarn_data))
+    log.info("Images saved to: %s", IMAGES_DIR)
+    log.info("Data saved to: %s and %s", output_file, stream_file)
     
     # Print summary
-    print("Sample results:")
+    log.info("Sample results:")
     for yarn in all_yarn_data[:5]:
-        print(f"  Name: {yarn['name']}")
-        print(f"  Hex: {yarn.get('hex_color', 'N/A')}")
+        log.info("  Name: %s", yarn['name'])
+        log.info("  Hex: %s", yarn.get('hex_color', 'N/A'))
 
 
 if __name__ == "__main__":